@@ -12,6 +12,11 @@ Module for finding an acceptable range in
 a network zone in the Micetro.
 """
 
+import ipaddress
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from ansible.module_utils.basic import AnsibleModule
 from ansible_collections.menandmice.ansible_micetro.plugins.module_utils.micetro import (
     doapi,
@@ -26,6 +31,8 @@ DOCUMENTATION = r"""
       - If a range like that is found, the new_title (if provided) will override the range's old title
       - Dry-run or check-mode is possible. In these cases this module only looks for the range,
         but does NOT modify the title (however the result's 'changed' field will be set to True in order to simulate changes)
+      - The range is first looked up with a server-side quickfilter. The network zone's range tree
+        is only walked when the quickfilter does not return an acceptable range
       - If no range is found, the module fails with an error message
     options:
       mm_provider:
@@ -90,6 +97,206 @@ message:
 """
 
 
+# Shared by the recursion to fetch the child ranges of a range in parallel
+_EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# Responses of the GET requests made during this run, keyed by (url, databody).
+# The executors' threads share it, so it is only accessed under _GET_CACHE_LOCK.
+_GET_CACHE = {}
+_GET_CACHE_LOCK = threading.Lock()
+
+
+def doapi_cached(url, method, mm_provider, databody):
+    # Same as doapi, but identical GET requests are answered from _GET_CACHE.
+    # Any other method invalidates the cached responses of the modified object.
+    if method == "GET":
+        key = (url, json.dumps(databody, sort_keys=True))
+        with _GET_CACHE_LOCK:
+            if key in _GET_CACHE:
+                return _GET_CACHE[key]
+        doapi_result = doapi(url, method, mm_provider, databody)
+        if not doapi_result.get("warnings", ""):
+            with _GET_CACHE_LOCK:
+                _GET_CACHE[key] = doapi_result
+        return doapi_result
+    with _GET_CACHE_LOCK:
+        for key in [key for key in _GET_CACHE if key[0] == url or key[0].startswith(url + "/")]:
+            del _GET_CACHE[key]
+    return doapi(url, method, mm_provider, databody)
+
+
+def doapi_cache_clear():
+    with _GET_CACHE_LOCK:
+        _GET_CACHE.clear()
+
+
+def doapi_batch(refs, mm_provider, doapi_fn=doapi_cached):
+    # Get many objects by their refs at once. The Micetro API has no bulk endpoint
+    # for this, so the GET requests are multiplexed over the shared executor.
+    # The results are yielded in the order of the refs as soon as they arrive,
+    # closing the iterator early cancels the requests which have not started yet.
+    return _EXECUTOR.map(lambda ref: doapi_fn(ref, "GET", mm_provider, {}), refs)
+
+
+class MicetroError(Exception):
+    pass
+
+
+class _FoundRange(Exception):
+    # Raised to stop the walk at the first match
+    def __init__(self, cidr):
+        super().__init__(cidr)
+        self.cidr = cidr
+
+
+def errcheck(doapi_result):
+    doapi_warnings = doapi_result.get("warnings", "")
+    if doapi_warnings:
+        raise MicetroError(f"{doapi_warnings}")
+    return doapi_result
+
+
+def get_prefix_length(cidr):
+    return int(cidr.rpartition("/")[2])
+
+
+def get_network(name):
+    # Returns None for names which are not networks (e.g. 10.0.0.5-10.0.0.9)
+    try:
+        return ipaddress.ip_network(name, strict=False)
+    except ValueError:
+        return None
+
+
+def walk_ranges(mm_provider, networks, target_prefix_length, title_substr, on_match, doapi_fn=doapi_cached, log=None):
+    # Find the first range in the networks with the target prefix length and a title
+    # containing title_substr (case-insensitive), for which on_match(range_obj) is truthy.
+    # Every visited range is reported to log (if given).
+    # Returns the CIDR of the range or None, raises MicetroError on API warnings.
+    target_prefix_length = int(target_prefix_length)
+    title_needle = (title_substr or "").lower()
+
+
+    def is_acceptable(range_obj, prefix_length):
+        if prefix_length != target_prefix_length:
+            return False
+        if not title_needle:
+            # Every title contains the empty string
+            return True
+        title_field = (range_obj.get("customProperties") or {}).get("Title") or ""
+        return title_needle in title_field.lower()
+
+
+    def get_quickfilter(network):
+        # Let the server look for the acceptable ranges of the network
+        quickfilter = f"{network} type:range prefixLength={target_prefix_length}"
+        if title_substr:
+            title_pattern = f"*{title_substr}*"
+            if any(char.isspace() or char in "\"\\" for char in title_pattern):
+                # Keep the title a single term of the filter
+                escaped_pattern = title_pattern.replace("\\", "\\\\").replace('"', '\\"')
+                title_pattern = f'"{escaped_pattern}"'
+            quickfilter += f" customProperties.Title:{title_pattern}"
+        return quickfilter
+
+
+    def match_filtered_ranges(network, net_ranges, filter_result):
+        # The quickfilter might not be supported by the server, so its result is
+        # not an error and the returned ranges are only used after checking them
+        if filter_result.get("warnings", ""):
+            return
+        # The ranges have to lie within the network, or when the network is given
+        # by its name, within one of its top-level ranges
+        net = get_network(network)
+        if net is not None:
+            containers = [net]
+        else:
+            containers = [get_network(net_range["name"]) for net_range in net_ranges]
+            containers = [container for container in containers if container is not None]
+        for range_obj in filter_result.get("message", {}).get("result", {}).get("ranges", []):
+            range_net = get_network(range_obj["name"])
+            if range_net is None or not is_acceptable(range_obj, range_net.prefixlen):
+                continue
+            if not any(
+                range_net.version == container.version and range_net.subnet_of(container)
+                for container in containers
+            ):
+                continue
+            if on_match(range_obj):
+                raise _FoundRange(range_obj["name"])
+
+
+    def match_range_tree(net_ranges):
+        # Walk the range tree level by level, so that the child ranges
+        # of a whole level are fetched with one batch
+        level = net_ranges
+        batch = None
+        try:
+            while True:
+                child_refs = []
+                for range_obj in level:
+                    curr_cidr = range_obj["name"]
+                    if log:
+                        log(f"Current range's cidr: {curr_cidr}")
+                    prefix_length = get_prefix_length(curr_cidr)
+                    if is_acceptable(range_obj, prefix_length) and on_match(range_obj):
+                        raise _FoundRange(curr_cidr)
+                    elif prefix_length < target_prefix_length:
+                        # The child stubs already contain the CIDR, so children
+                        # which are smaller than the target are skipped without fetching them
+                        child_refs.extend(
+                            child["ref"] for child in range_obj.get("childRanges") or []
+                            if "name" not in child or get_prefix_length(child["name"]) <= target_prefix_length
+                        )
+                if not child_refs:
+                    return
+                # The ranges of the next level are checked as they arrive,
+                # so a match stops fetching the rest of the level
+                batch = doapi_batch(child_refs, mm_provider, doapi_fn)
+                level = (
+                    errcheck(child_range_result)["message"]["result"]["range"]
+                    for child_range_result in batch
+                )
+        finally:
+            if batch is not None:
+                batch.close()
+
+    # Request the filtered and the plain ranges of the networks in parallel, as the
+    # lookups are independent. The pool is capped, so the lookups of the later
+    # networks are still queued (and can be cancelled) when an earlier one matches.
+    executor = ThreadPoolExecutor(max_workers=max(min(2 * len(networks), 8), 1))
+    futures = [
+        (
+            executor.submit(doapi_fn, "Ranges", "GET", mm_provider, {"filter": get_quickfilter(network)}),
+            executor.submit(doapi_fn, "Ranges", "GET", mm_provider, {"filter": network}),
+        )
+        for network in networks
+    ]
+    try:
+        # Loop over all networks (in the provided order) to find a desirable network range
+        for network, (filter_future, network_future) in zip(networks, futures):
+            network_result = errcheck(network_future.result())
+            net_ranges = network_result.get("message").get("result", {}).get("ranges", [])
+
+            match_filtered_ranges(network, net_ranges, filter_future.result())
+
+            # Check if any ranges were found
+            if not net_ranges:
+                continue
+
+            # Fall back to walking the range tree of the network
+            match_range_tree(net_ranges)
+    except _FoundRange as found:
+        return found.cidr
+    finally:
+        # Cancel the queued lookups which are not needed anymore
+        for network_futures in futures:
+            for future in network_futures:
+                future.cancel()
+        executor.shutdown(wait=False)
+    return None
+
+
 def run_module():
     # Define available arguments/parameters a user can pass to the module
     module_args = dict(
@@ -121,8 +328,8 @@ def run_module():
     # Get the parameters
     mm_provider = module.params["mm_provider"]
     try:
-        # Ensure all elements are strings and strip whitespace
-        networks = [str(net).strip() for net in module.params["network"] if net]
+        # Ensure all elements are strings, strip whitespace and drop duplicates (keeping the order)
+        networks = list(dict.fromkeys(str(net).strip() for net in module.params["network"] if net and str(net).strip()))
     except Exception as e:
         module.fail_json(msg=f"Error processing networks input: {str(e)}")
     target_prefix_length = module.params["prefixlength"]
@@ -130,65 +337,39 @@ def run_module():
     new_title_text = module.params["new_title"]
 
 
-    def doapi_with_errcheck(url, method, mm_provider, databody):
-        doapi_result = doapi(url, method, mm_provider, databody)
-        doapi_warnings = doapi_result.get("warnings", "")
-        if doapi_warnings:
-            module.fail_json(msg=f"{doapi_warnings}")
-        return doapi_result
-
+    def select_range(range_obj):
+        # Modify the range's title (e.g. reserve it by changing the title to reserved)
+        if new_title_text:
+            if not module.check_mode:
+                range_ref = range_obj["ref"]
+                url = f"{range_ref}"
+                http_method = "PUT"
+                databody = {
+                  "ref": range_ref,
+                  "properties": {
+                    "Title": new_title_text
+                  },
+                  "saveComment": "Ansible API"
+                }
+                update_title_res = errcheck(doapi_cached(url, http_method, mm_provider, databody))
+            module_result["changed"] = True
+        return True
 
-    def recurse_ranges(range_obj):
-        curr_cidr = range_obj["name"]
-        print(f"Current range's cidr: {curr_cidr}")
-        _, prefix_length = curr_cidr.split("/")
-        if int(prefix_length) == int(target_prefix_length) and title_text in range_obj.get("customProperties", {}).get("Title", "").lower():
-            # Modify the range's title (e.g. reserve it by changing the title to reserved)
-            if new_title_text:
-                if not module.check_mode:
-                    range_ref = range_obj["ref"]
-                    url = f"{range_ref}"
-                    http_method = "PUT"
-                    databody = {
-                      "ref": range_ref,
-                      "properties": {
-                        "Title": new_title_text
-                      },
-                      "saveComment": "Ansible API"
-                    }
-                    update_title_res = doapi_with_errcheck(url, http_method, mm_provider, databody)
-                module_result["changed"] = True
-            module_result["message"] = curr_cidr
-            module.exit_json(**module_result)
-        elif int(prefix_length) < 28 and range_obj.get("childRanges"):
-            # Recurse into child ranges
-            for child in range_obj["childRanges"]:
-                child_ref = child["ref"]
-                url = f"{child_ref}"
-                http_method = "GET"
-                child_range_result = doapi_with_errcheck(url, http_method, mm_provider, {})
-                child_range = child_range_result["message"]["result"]["range"]
-                recurse_ranges(child_range)
-
-    # Loop over all networks to find a desirable network range
-    for network in networks:
-        # Get the requested network ranges
-        http_method = "GET"
-        url = "Ranges"
-        databody = {"filter": network}
-        network_result = doapi_with_errcheck(url, http_method, mm_provider, databody)
-
-        # Check if any ranges were found
-        if not network_result.get("message").get("result", {}).get("ranges", []):
-            continue
-
-        # Iterate through ranges to find a desirable network range
-        net_ranges = network_result["message"]["result"]["ranges"]
-        for net_range in net_ranges:
-            recurse_ranges(net_range)
+    try:
+        found_cidr = walk_ranges(
+            mm_provider, networks, target_prefix_length, title_text, select_range,
+            # Only format the visit log when it is going to be written
+            log=module.debug if module._debug else None,
+        )
+    except MicetroError as e:
+        module.fail_json(msg=f"{str(e)}")
 
     # If no acceptable range found, raise an error
-    module.fail_json(msg=f"No acceptable /{target_prefix_length} range found in the provided network(s).")
+    if not found_cidr:
+        module.fail_json(msg=f"No acceptable /{target_prefix_length} range found in the provided network(s).")
+
+    module_result["message"] = found_cidr
+    module.exit_json(**module_result)
 
 
 def main():
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Men&Mice
+# GNU General Public License v3.0
+# see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+"""Tests for the range search of the findrange module."""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("ansible")
+pytest.importorskip("ansible_collections.menandmice.ansible_micetro.plugins.module_utils.micetro")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "library"))
+import findrange  # noqa: E402
+
+
+def make_range(name, title="", children=()):
+    return {
+        "ref": f"Ranges/{name}",
+        "name": name,
+        "customProperties": {"Title": title},
+        "childRanges": [{"ref": f"Ranges/{child}", "name": child} for child in children],
+    }
+
+
+class FakeMicetro:
+    # Answers the doapi calls of walk_ranges from a fixed set of ranges.
+    # Quickfilter lookups (filters with more than one term) return filtered_ranges.
+    def __init__(self, ranges, networks, filtered_ranges=(), delay=0.0, warnings=None):
+        self.ranges = {range_obj["ref"]: range_obj for range_obj in ranges}
+        self.networks = networks
+        self.filtered_ranges = list(filtered_ranges)
+        self.delay = delay
+        self.warnings = warnings or {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url, method, mm_provider, databody):
+        time.sleep(self.delay)
+        with self.lock:
+            self.calls.append((url, method, databody))
+        if url in self.warnings:
+            return {"warnings": self.warnings[url]}
+        if url == "Ranges":
+            if " " in databody["filter"]:
+                ranges = self.filtered_ranges
+            else:
+                ranges = [self.ranges[ref] for ref in self.networks.get(databody["filter"], [])]
+            return {"message": {"result": {"ranges": ranges}}}
+        return {"message": {"result": {"range": self.ranges[url]}}}
+
+
+def walk(api, networks, prefix_length=28, title="free"):
+    return findrange.walk_ranges({}, networks, prefix_length, title, lambda range_obj: True, doapi_fn=api)
+
+
+def test_first_match_follows_network_order():
+    api = FakeMicetro(
+        [
+            make_range("10.0.0.0/24", children=["10.0.0.0/28"]),
+            make_range("10.0.0.0/28", "Free"),
+            make_range("10.1.0.0/28", "free"),
+        ],
+        {"netA": ["Ranges/10.0.0.0/24"], "netB": ["Ranges/10.1.0.0/28"]},
+    )
+    assert walk(api, ["netA", "netB"]) == "10.0.0.0/28"
+    assert walk(api, ["netB", "netA"]) == "10.1.0.0/28"
+
+
+def test_api_warning_raises_micetro_error():
+    api = FakeMicetro(
+        [make_range("10.0.0.0/24", children=["10.0.0.0/28"])],
+        {"netA": ["Ranges/10.0.0.0/24"]},
+        warnings={"Ranges/10.0.0.0/28": "Access denied"},
+    )
+    with pytest.raises(findrange.MicetroError, match="Access denied"):
+        walk(api, ["netA"])
+
+
+def test_later_network_lookups_are_cancelled():
+    networks = {f"net{i}": [] for i in range(20)}
+    networks["net0"] = ["Ranges/10.0.0.0/28"]
+    api = FakeMicetro([make_range("10.0.0.0/28", "free")], networks, delay=0.05)
+    assert walk(api, list(networks)) == "10.0.0.0/28"
+    # Let the lookups which were already running finish
+    time.sleep(0.2)
+    assert len(api.calls) < 2 * len(networks)
+
+
+def test_cache_invalidation_matches_refs_exactly(monkeypatch):
+    monkeypatch.setattr(findrange, "doapi", lambda url, method, mm_provider, databody: {"message": url})
+    findrange.doapi_cache_clear()
+    for url in ["Ranges/12", "Ranges/123", "Ranges/12/children"]:
+        findrange.doapi_cached(url, "GET", {}, {})
+    findrange.doapi_cached("Ranges/12", "PUT", {}, {})
+    assert [key[0] for key in findrange._GET_CACHE] == ["Ranges/123"]
+    findrange.doapi_cache_clear()
+
+
+def test_quickfilter_match_must_lie_within_named_network():
+    ranges = [
+        make_range("10.0.0.0/24", children=["10.0.0.128/28"]),
+        make_range("10.0.0.128/28", "Free"),
+    ]
+    unrelated = make_range("192.168.9.0/28", "free")
+    api = FakeMicetro(ranges, {"netA": ["Ranges/10.0.0.0/24"]}, filtered_ranges=[unrelated])
+    assert walk(api, ["netA"]) == "10.0.0.128/28"
+
+
+def test_quickfilter_match_within_named_network_skips_walk():
+    ranges = [
+        make_range("10.0.0.0/24", children=["10.0.0.128/28"]),
+        make_range("10.0.0.128/28", "Free"),
+    ]
+    api = FakeMicetro(ranges, {"netA": ["Ranges/10.0.0.0/24"]}, filtered_ranges=[ranges[1]])
+    assert walk(api, ["netA"]) == "10.0.0.128/28"
+    assert all(url == "Ranges" for url, _, _ in api.calls)
+
+
+def test_quickfilter_skips_address_ranges():
+    api = FakeMicetro(
+        [make_range("10.0.0.16/28", "free")],
+        {},
+        filtered_ranges=[make_range("10.0.0.5-10.0.0.9", "free"), make_range("10.0.0.16/28", "free")],
+    )
+    assert walk(api, ["10.0.0.0/24"]) == "10.0.0.16/28"
+
+
+def test_quickfilter_keeps_title_a_single_term():
+    api = FakeMicetro([], {})
+    assert walk(api, ["10.0.0.0/24"], title='is "free"') is None
+    filters = [databody["filter"] for _, _, databody in api.calls]
+    assert '10.0.0.0/24 type:range prefixLength=28 customProperties.Title:"*is \\"free\\"*"' in filters
+    assert walk(api, ["10.0.0.0/24"], title="free") is None
+    assert "10.0.0.0/24 type:range prefixLength=28 customProperties.Title:*free*" in [
+        databody["filter"] for _, _, databody in api.calls
+    ]